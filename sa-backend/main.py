@@ -1,22 +1,51 @@
+import asyncio
 import json
-import pdfplumber
+import orjson
+import multiprocessing
 import re
+import threading
 import os
 import logging
 import uuid
+import weakref
+import redis.asyncio
+from collections import deque
+from cachetools import TTLCache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import aclosing, asynccontextmanager, suppress
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Depends, Request, Header
+from fastapi import BackgroundTasks, FastAPI, File, Form, UploadFile, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict
-from langchain_core.prompts import ChatPromptTemplate
+from starlette.background import BackgroundTask
+from typing import Optional, Dict, List
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, get_buffer_string, messages_from_dict, messages_to_dict
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough, RunnableLambda
+from langchain_core.runnables import Runnable, RunnableLambda
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.memory import ConversationSummaryMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+import pdf_text
+from prompts import DIET_PROMPT, MEDICAL_PROMPT
+
+# Startup and shutdown: the LLM clients are built inside the serving loop, and background
+# tasks live for as long as the app serves requests
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    build_llm_chains()
+    session_expiry_task = asyncio.create_task(expire_sessions())
+    try:
+        yield
+    finally:
+        session_expiry_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await session_expiry_task
+
 
 # FastAPI app setup
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://pocket-doctor-ohey.onrender.com", "http://localhost:3000"],
@@ -35,390 +64,727 @@ load_dotenv()
 api_key = os.getenv("GOOGLE_API_KEY")
 if not api_key:
     raise ValueError("GOOGLE_API_KEY not set in .env file.")
-
-# Session memory dictionary
-session_memories: Dict[str, ConversationSummaryMemory] = {}
+redis_url = os.getenv("REDIS_URL")
+# With REDIS_URL set, session state is shared across workers and survives restarts,
+# and SessionLock serializes a session's turns across workers too
+redis_client = redis.asyncio.from_url(redis_url) if redis_url else None
+
+SESSION_TTL_SECONDS = 1800
+# Messages kept verbatim per session; the oldest half is summarized when this fills up
+SESSION_RECENT_MESSAGES = 12
+# Rough token budget for those messages; long turns (e.g. PDF text) are summarized sooner
+SESSION_RECENT_TOKENS = 4000
+
+# Session cache of SessionState entries; sessions idle for 30 minutes are evicted, and the
+# least recently used ones are dropped once MAX_SESSIONS is reached
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+session_memories: TTLCache = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL_SECONDS)
+# TTLCache is not thread-safe; guard it in case it's touched from the threadpool
+session_memories_lock = threading.RLock()
+
+# PDF parsing runs in worker processes: PDFium is not thread-safe, and "spawn"
+# keeps workers from inheriting the app's gRPC channels (they only import pdf_text)
+PDF_WORKERS = 4
+# Pages parsed by the first worker task; documents up to this size are handled in one task
+PDF_PAGES_PER_TASK = 8
+# Pages past this are ignored; the model only needs the report, not a whole appendix
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "50"))
 
 # File handler
 async def get_file(file: Optional[UploadFile] = File(None)) -> Optional[UploadFile]:
     return file if file and file.filename else None
 
+def _new_pdf_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+_pdf_executor = _new_pdf_executor()
+
+
+# A worker that dies (PDFium crash, OOM kill) breaks the whole pool for good, so swap in a new one
+def _replace_broken_pdf_executor(broken: ProcessPoolExecutor):
+    global _pdf_executor
+    if _pdf_executor is broken:
+        _pdf_executor = _new_pdf_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+
+async def extract_pdf_text(executor: ProcessPoolExecutor, data: bytes) -> str:
+    loop = asyncio.get_running_loop()
+    first_stop = min(PDF_PAGES_PER_TASK, PDF_MAX_PAGES)
+    first, page_count = await loop.run_in_executor(executor, pdf_text.extract_page_range, data, 0, first_stop)
+    # Every task pickles the whole upload and reopens the document, so the rest of a long
+    # document is split into at most one range per worker rather than many small ones
+    last = min(page_count, PDF_MAX_PAGES)
+    step = max(PDF_PAGES_PER_TASK, -(-(last - first_stop) // PDF_WORKERS))
+    rest = await asyncio.gather(*(
+        loop.run_in_executor(executor, pdf_text.extract_page_range, data, start, min(start + step, last))
+        for start in range(first_stop, last, step)
+    ))
+    return "\n".join([first] + [text for text, _ in rest])
+
+
 async def process_pdf(file: UploadFile) -> str:
     try:
-        with pdfplumber.open(file.file) as pdf:
-            return "".join([page.extract_text() or "" for page in pdf.pages])
+        data = await file.read()
+        executor = _pdf_executor
+        try:
+            return await extract_pdf_text(executor, data)
+        except BrokenProcessPool as e:
+            logger.error("PDF worker died, restarting the pool and falling back to pypdf: %s", e)
+            _replace_broken_pdf_executor(executor)
+        except Exception as e:
+            logger.warning("PDFium failed to extract text, falling back to pypdf: %s", e)
+        # pypdf is pure Python, so a thread is enough and it doesn't depend on the pool
+        return await asyncio.to_thread(pdf_text.extract_with_pypdf, data, PDF_MAX_PAGES)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error reading PDF: {str(e)}")
 
 # LLM initialization
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.1, google_api_key=api_key)
+# The Gemini clients and the chains that use them are created by build_llm_chains() at startup
+llm: Optional[ChatGoogleGenerativeAI] = None
+# Cheaper model used only to summarize history once a session's message buffer fills up
+summary_llm: Optional[ChatGoogleGenerativeAI] = None
+
+# Gemini-native response schema (OpenAPI subset) matching the JSON shape the prompts ask for
+_STRING = {"type": "STRING", "nullable": True}
+_STRING_LIST = {"type": "ARRAY", "nullable": True, "items": {"type": "STRING"}}
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "question": _STRING,
+        "diagnosis": {
+            "type": "OBJECT",
+            "nullable": True,
+            "properties": {
+                "condition": _STRING,
+                "probability": {"type": "NUMBER", "nullable": True},
+                "medical_tests": _STRING_LIST,
+                "modern_medication": _STRING_LIST,
+                "lifestyle_changes": _STRING_LIST,
+                "precautions": _STRING,
+            },
+            "required": ["condition", "probability", "medical_tests", "modern_medication",
+                         "lifestyle_changes", "precautions"],
+        },
+        "home_remedy": _STRING,
+        "diet_plan": _STRING,
+    },
+    "required": ["question", "diagnosis", "home_remedy", "diet_plan"],
+}
+
+# Chat model constrained to emit schema-valid JSON, so parse_response's fast path almost always hits
+json_llm: Optional[Runnable] = None
+
+
+@dataclass(slots=True)
+class SessionState:
+    """Conversation state kept per session: a running summary plus the most recent messages."""
+    summary: str = ""
+    # No maxlen: append_turn bounds it, and a failed summary must not silently drop messages
+    recent: deque = field(default_factory=deque)
+
+
+# Folds old messages into the running summary; only runs when a session's buffer fills up
+summary_chain: Optional[Runnable] = None
+
+
+def load_history(state: SessionState) -> List[BaseMessage]:
+    history: List[BaseMessage] = [SystemMessage(content=state.summary)] if state.summary else []
+    history.extend(state.recent)
+    return history
+
+
+# ~4 characters per token; close enough to decide when to summarize
+def estimate_tokens(messages) -> int:
+    return sum(len(message.content) for message in messages) // 4
+
+
+async def append_turn(state: SessionState, input_text: str, response: str):
+    state.recent.append(HumanMessage(content=input_text))
+    state.recent.append(AIMessage(content=response))
+    if len(state.recent) < SESSION_RECENT_MESSAGES and estimate_tokens(state.recent) <= SESSION_RECENT_TOKENS:
+        return
+
+    # Fold whole turns, oldest first, down to half the buffer and within the token budget;
+    # the latest turn is always kept verbatim
+    recent = list(state.recent)
+    count = 0
+    while len(recent) - count > 2 and (len(recent) - count > SESSION_RECENT_MESSAGES // 2
+                                       or estimate_tokens(recent[count:]) > SESSION_RECENT_TOKENS):
+        count += 2
+    if not count:
+        return
+
+    try:
+        state.summary = await summary_chain.ainvoke({"summary": state.summary, "new_lines": get_buffer_string(recent[:count])})
+    except Exception as e:
+        # Keep the messages verbatim; the fold is retried on the next turn
+        logger.exception("Failed to summarize session history: %s", e)
+        return
+    # Only trim once the summary holds them
+    for _ in range(count):
+        state.recent.popleft()
+
+
+# Get or create the local session state
+def get_session(session_id: str) -> SessionState:
+    with session_memories_lock:
+        state = session_memories.get(session_id)
+        if state is None:
+            logger.info("Created new session state for session: %s", session_id)
+            state = SessionState()
+        # Re-inserting restarts the TTL, so only idle sessions expire
+        session_memories[session_id] = state
+        return state
+
+
+def _session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+# Return the session state, refreshed from Redis when configured so other workers' turns are seen
+async def load_session_state(session_id: str) -> SessionState:
+    state = get_session(session_id)
+    if redis_client is not None:
+        raw = await redis_client.get(_session_key(session_id))
+        # Update in place so a turn already holding this object records onto the fresh history.
+        # Redis is the source of truth: a missing key means the session was closed or expired,
+        # possibly on another worker, so this worker's copy must not bring it back.
+        state.summary = ""
+        state.recent.clear()
+        if raw:
+            data = orjson.loads(raw)
+            state.summary = data["summary"]
+            state.recent.extend(messages_from_dict(data["recent"]))
+    return state
+
+
+async def store_session_state(session_id: str, state: SessionState):
+    if redis_client is not None:
+        data = {"summary": state.summary, "recent": messages_to_dict(list(state.recent))}
+        await redis_client.set(_session_key(session_id), orjson.dumps(data), ex=SESSION_TTL_SECONDS)
+
+
+async def close_session(session_id: str):
+    with session_memories_lock:
+        session_memories.pop(session_id, None)
+    if redis_client is not None:
+        await redis_client.delete(_session_key(session_id))
+
+
+# Longest a turn may hold a session's Redis lock; it expires after this if a worker dies mid-turn
+SESSION_LOCK_TIMEOUT_SECONDS = 120
+
+
+class SessionLock:
+    """
+    Serializes a session's turns, so concurrent requests (e.g. a double submit) can't both
+    summarize and overwrite the same history. An asyncio.Lock covers this worker; with Redis
+    configured, a Redis lock on top covers turns that land on other workers.
+    """
+
+    def __init__(self, session_id: str):
+        self.name = f"lock:{_session_key(session_id)}"
+        self.local = asyncio.Lock()
+        self.shared = None
+
+    async def acquire(self):
+        await self.local.acquire()
+        if redis_client is None:
+            return
+        try:
+            shared = redis_client.lock(self.name, timeout=SESSION_LOCK_TIMEOUT_SECONDS,
+                                       blocking_timeout=SESSION_LOCK_TIMEOUT_SECONDS)
+            if not await shared.acquire():
+                raise TimeoutError(f"Timed out waiting for {self.name}")
+            self.shared = shared
+        except BaseException:
+            self.local.release()
+            raise
+
+    async def release(self):
+        try:
+            if self.shared is not None:
+                shared, self.shared = self.shared, None
+                await shared.release()
+        except redis.exceptions.LockError as e:
+            # It expired and may now be held by another turn; nothing left to release
+            logger.warning("Session lock %s was lost before release: %s", self.name, e)
+        finally:
+            self.local.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+
+# Entries disappear once no turn holds them
+session_locks: "weakref.WeakValueDictionary[str, SessionLock]" = weakref.WeakValueDictionary()
+
+
+def get_session_lock(session_id: str) -> SessionLock:
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = SessionLock(session_id)
+        session_locks[session_id] = lock
+    return lock
+
+
+# Append a turn and persist it; the caller must hold the session lock
+async def record_session_turn(session_id: str, state: SessionState, input_text: str, result: Dict):
+    await append_turn(state, input_text, orjson.dumps(result).decode())
+    await store_session_state(session_id, state)
+
+
+# Background save for a turn. It takes the session lock afresh and reloads the state: handlers
+# release the lock themselves, since background tasks never run if sending the response fails
+async def save_session_turn(session_id: str, input_text: str, result: Dict):
+    async with get_session_lock(session_id):
+        state = await load_session_state(session_id)
+        await record_session_turn(session_id, state, input_text, result)
+
+
+# Expired entries are only purged on cache mutation, so sweep periodically
+async def expire_sessions(interval: int = 60):
+    while True:
+        await asyncio.sleep(interval)
+        with session_memories_lock:
+            session_memories.expire()
 
 
 #       Function to parse the response from LLM
 # 
 #  
 
+# Patterns used on every LLM response, compiled once at import
+_JSON_FENCE_RE = re.compile(r"```json\s*(.*?)\s*```", re.DOTALL)
+_BLANK_LINES_RE = re.compile(r"\n\s*\n")
+# Next brace or quote, and the rest of a string literal up to its closing (unescaped) quote
+_JSON_STRUCTURE_RE = re.compile(r'[{}"]')
+_STRING_TAIL_RE = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_NEWLINE_ESCAPES = str.maketrans({"\n": "\\n", "\r": "\\r"})
+_CLEANUP_RE = re.compile(r"\*\*|\r\n?")
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _cleanup_replacement(match: re.Match) -> str:
+    # Drop bold markers, normalize \r\n and \r to \n
+    return "" if match.group() == "**" else "\n"
+
 
 def extract_json_object(text: str) -> str:
     """
-    Extract the first complete JSON object from a string.
-    This avoids the limitations of regex by matching balanced braces.
+    Extract the first complete JSON object from a string by matching balanced braces.
+    Jumps between braces and quotes, so runs of other text and braces inside strings are skipped.
     """
     start = text.find('{')
     if start == -1:
         raise ValueError("No opening brace found in response.")
 
-    stack = []
-    for i in range(start, len(text)):
-        if text[i] == '{':
-            stack.append('{')
-        elif text[i] == '}':
-            stack.pop()
-            if not stack:
-                return text[start:i + 1]
+    depth = 0
+    pos = start
+    while True:
+        match = _JSON_STRUCTURE_RE.search(text, pos)
+        if match is None:
+            break
+        char, pos = match.group(), match.end()
+        if char == '"':
+            tail = _STRING_TAIL_RE.match(text, pos)
+            if tail is None:
+                break
+            pos = tail.end()
+        elif char == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return text[start:pos]
 
     raise ValueError("No matching closing brace found in response.")
 
 
-def clean_markdown(text: str) -> str:
-    """Remove markdown artifacts and normalize line breaks."""
-    if not isinstance(text, str):
-        return text
-    text = text.replace("**", "").replace("\r\n", "\n").replace("\r", "\n")
-    return re.sub(r"\n\s*\n", "\n", text).strip()
+@dataclass(slots=True)
+class JsonObjectScanner:
+    """Incremental brace matcher for streamed output; braces inside string values are ignored."""
+    depth: int = 0
+    in_string: bool = False
+    escaped: bool = False
+
+    def feed(self, chunk: str) -> int:
+        """Return the offset just past the brace that closes the first top-level object, or -1."""
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '{':
+                self.depth += 1
+            elif char == '"':
+                # Quotes in prose before the object don't start a string
+                self.in_string = self.depth > 0
+            elif char == '}' and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return -1
+
 
 def escape_unescaped_newlines(text: str) -> str:
     """
-    Escapes unescaped newline characters that are inside double-quoted JSON strings.
+    Escapes unescaped newline and carriage return characters inside quoted JSON string values.
+    Single pass: text between strings is copied as-is and each string literal is translated once.
     """
-    # This regex finds all strings: " ... "
-    pattern = r'"(.*?)"'
-    def replacer(match):
-        content = match.group(1)
-        # Only escape newlines and carriage returns if they exist unescaped
-        content_escaped = content.replace('\n', '\\n').replace('\r', '\\r')
-        return f'"{content_escaped}"'
+    parts = []
+    pos = 0
+    while True:
+        quote = text.find('"', pos)
+        if quote == -1:
+            break
+        tail = _STRING_TAIL_RE.match(text, quote + 1)
+        end = tail.end() if tail else len(text)
+        parts.append(text[pos:quote])
+        parts.append(text[quote:end].translate(_NEWLINE_ESCAPES))
+        pos = end
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def clean_markdown(text: str) -> str:
+    """Remove markdown artifacts and normalize line breaks."""
+    if not isinstance(text, str):
+        return text
+    # Most fields have no markers and at most one line break; a blank line needs two
+    if "**" not in text and "\r" not in text and text.count("\n") < 2:
+        return text.strip()
+    text = _CLEANUP_RE.sub(_cleanup_replacement, text)
+    return _BLANK_LINES_RE.sub("\n", text).strip()
 
-    return re.sub(pattern, replacer, text, flags=re.DOTALL)
 
+def clean_text_field(value) -> Optional[str]:
+    """clean_markdown for fields the API types as strings; other scalars become str, anything else None."""
+    if value is None or isinstance(value, str):
+        return clean_markdown(value)
+    if isinstance(value, (int, float)):
+        return str(value)
+    return None
 
-import json
-import re
-import logging
-from typing import Dict
 
-logger = logging.getLogger(__name__)
+def clean_markdown_list(items: Optional[List[str]]) -> Optional[List[str]]:
+    """clean_markdown for list fields; anything else (e.g. a fallback-parsed string) is cleaned as-is."""
+    if not isinstance(items, list):
+        return clean_markdown(items)
+    return [clean_markdown(item) for item in items]
 
 
-def extract_json_object(text: str) -> str:
+def decode_first_json_object(text: str):
     """
-    Extract the first complete JSON object from a string by matching balanced braces.
+    Decode the JSON value starting at the first opening brace.
+    raw_decode reports where the value ends, so no regex or brace matching is needed.
     """
     start = text.find('{')
     if start == -1:
         raise ValueError("No opening brace found in response.")
+    parsed, _ = _JSON_DECODER.raw_decode(text, start)
+    return parsed
 
-    stack = []
-    for i in range(start, len(text)):
-        if text[i] == '{':
-            stack.append('{')
-        elif text[i] == '}':
-            stack.pop()
-            if not stack:
-                return text[start:i + 1]
 
-    raise ValueError("No matching closing brace found in response.")
-
-
-def escape_unescaped_newlines(text: str) -> str:
+def load_response_json(response: str):
     """
-    Escapes unescaped newline and carriage return characters inside quoted JSON string values.
+    Decode the JSON payload of an LLM response, trying the cheapest strategy first.
+    Sanitizing only runs when the raw response isn't valid JSON.
     """
-    def replacer(match):
-        content = match.group(1)
-        # Escape only actual newlines and returns (not already escaped ones)
-        content = content.replace('\r', '\\r').replace('\n', '\\n')
-        return f'"{content}"'
+    response_stripped = response.strip()
+    # Only a bare object can decode whole; fenced or chatty replies go straight to Step 3
+    is_bare_object = response_stripped.startswith("{")
 
-    return re.sub(r'"(.*?)"', replacer, text, flags=re.DOTALL)
+    # Step 1: Fast path; the prompt asks for strict JSON, so this usually succeeds
+    if is_bare_object:
+        try:
+            return orjson.loads(response_stripped)
+        except orjson.JSONDecodeError:
+            pass
 
+    # Step 2: Escape raw newlines inside strings and try the full response again
+    response_cleaned = escape_unescaped_newlines(response_stripped)
+    if is_bare_object:
+        try:
+            return orjson.loads(response_cleaned)
+        except orjson.JSONDecodeError:
+            pass
 
-def clean_markdown(text: str) -> str:
-    """Remove markdown artifacts and normalize line breaks."""
-    if not isinstance(text, str):
-        return text
-    text = text.replace("**", "").replace("\r\n", "\n").replace("\r", "\n")
-    return re.sub(r"\n\s*\n", "\n", text).strip()
+    # Step 3: Decode the first {...} in place; fences or prose around it are ignored
+    try:
+        return decode_first_json_object(response_cleaned)
+    except ValueError:
+        pass
+
+    # Step 4: Try extracting from ```json ... ``` block
+    json_match = _JSON_FENCE_RE.search(response)
+    if json_match:
+        return orjson.loads(escape_unescaped_newlines(json_match.group(1).strip()))
+
+    # Step 5: Try extracting balanced {...} JSON object
+    return orjson.loads(escape_unescaped_newlines(extract_json_object(response)))
+
+
+# Returned when an LLM reply can't be parsed
+PARSE_FAILURE_RESPONSE = {
+    "question": "Sorry, something went wrong while processing your input. Type 'retry' to try again.",
+    "diagnosis": None,
+    "home_remedy": None,
+    "diet_plan": None
+}
 
 
 def parse_response(response: str) -> Dict:
     try:
-        # Step 1: Try full response as JSON
-        try:
-            response_cleaned = escape_unescaped_newlines(response.strip())
-            parsed = json.loads(response_cleaned)
-        except json.JSONDecodeError:
-            # Step 2: Try extracting from ```json ... ``` block
-            json_match = re.search(r"```json\s*(.*?)\s*```", response, re.DOTALL)
-            if json_match:
-                cleaned = escape_unescaped_newlines(json_match.group(1).strip())
-                parsed = json.loads(cleaned)
-            else:
-                # Step 3: Try extracting balanced {...} JSON object
-                cleaned = escape_unescaped_newlines(extract_json_object(response))
-                parsed = json.loads(cleaned)
+        parsed = load_response_json(response)
 
         if not isinstance(parsed, dict):
             raise ValueError(f"Expected JSON object but got {type(parsed).__name__}")
 
         # Clean known fields
         result = {
-            "question": clean_markdown(parsed.get("question")),
+            "question": clean_text_field(parsed.get("question")),
             "diagnosis": None,
-            "home_remedy": clean_markdown(parsed.get("home_remedy")),
-            "diet_plan": clean_markdown(parsed.get("diet_plan")),
+            "home_remedy": clean_text_field(parsed.get("home_remedy")),
+            "diet_plan": clean_text_field(parsed.get("diet_plan")),
         }
 
+        # The diagnosis shape is fixed by RESPONSE_SCHEMA, so clean each field directly
         diagnosis = parsed.get("diagnosis")
         if isinstance(diagnosis, dict):
-            cleaned_diagnosis = {}
-            for key, value in diagnosis.items():
-                if isinstance(value, str):
-                    cleaned_diagnosis[key] = clean_markdown(value)
-                elif isinstance(value, list):
-                    cleaned_diagnosis[key] = [clean_markdown(item) for item in value]
-                else:
-                    cleaned_diagnosis[key] = value
-            result["diagnosis"] = cleaned_diagnosis
+            result["diagnosis"] = {
+                "condition": clean_text_field(diagnosis.get("condition")),
+                "probability": diagnosis.get("probability"),
+                "medical_tests": clean_markdown_list(diagnosis.get("medical_tests")),
+                "modern_medication": clean_markdown_list(diagnosis.get("modern_medication")),
+                "lifestyle_changes": clean_markdown_list(diagnosis.get("lifestyle_changes")),
+                "precautions": clean_text_field(diagnosis.get("precautions")),
+            }
 
         return result
 
-    except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON: {e} | Cleaned: {cleaned if 'cleaned' in locals() else 'N/A'} | Full: {response}")
+    except orjson.JSONDecodeError as e:
+        logger.error("Invalid JSON: %s | Full: %s", e, response)
     except Exception as e:
-        logger.exception(f"Unexpected error while parsing LLM response: {e}")
+        logger.exception("Unexpected error while parsing LLM response: %s", e)
 
     # Fallback response
-    return {
-        "question": "Sorry, something went wrong while processing your input. Type 'retry' to try again.",
-        "diagnosis": None,
-        "home_remedy": None,
-        "diet_plan": None
-    }
+    return dict(PARSE_FAILURE_RESPONSE)
 
 
+# Replies to identical opening messages (e.g. "hi") so new sessions skip the Gemini round-trip.
+# In memory and bounded only: turns with history or an upload are never cached, so patient
+# details and reports don't end up here, and failed parses are never stored.
+first_turn_cache: TTLCache = TTLCache(maxsize=256, ttl=3600)
 
+# Chat pipeline; each turn passes {"input": ..., "chat_history": ...}
+chat_chain: Optional[Runnable] = None
+# Diet pipeline; each turn passes {"input": ..., "chat_history": ..., "condition": ...}
+diet_chain: Optional[Runnable] = None
 
 
+def build_llm_chains():
+    """
+    Create the Gemini clients and every chain built on them, once per process.
+    langchain-google-genai only creates the async client inside a running event loop, and
+    gunicorn's UvicornWorker, `fastapi run` and TestClient all import this module before one
+    exists. So this runs from the lifespan handler, and again (as a no-op) at the start of each
+    handler for servers and test clients that skip lifespan events.
+    """
+    global llm, summary_llm, json_llm, summary_chain, chat_chain, diet_chain
+    if llm is not None:
+        return
+
+    # Async calls go through the client's default grpc_asyncio transport, which opens one
+    # HTTP/2 channel and multiplexes every concurrent Gemini call over it. Don't pass
+    # `transport`: the library applies it to the async client too, and "grpc"/"rest" break ainvoke.
+    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.1, google_api_key=api_key)
+    summary_llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite", temperature=0.1, google_api_key=api_key)
+    json_llm = llm.bind(generation_config={"response_mime_type": "application/json", "response_schema": RESPONSE_SCHEMA})
+
+    summary_chain = SUMMARY_PROMPT | summary_llm | StrOutputParser()
+    chat_chain = (
+        MEDICAL_PROMPT
+        | json_llm
+        | StrOutputParser()
+        | RunnableLambda(parse_response)
+    )
+    diet_chain = (
+        DIET_PROMPT
+        | json_llm
+        | StrOutputParser()
+        | RunnableLambda(parse_response)
+    )
+
+
+# Build the LLM input from the uploaded PDF text and the user's message
+async def build_input_text(message: Optional[str], file: Optional[UploadFile]) -> str:
+    # Reject before reading the upload, which is the expensive part
+    if not file and not (message and message.strip()):
+        raise HTTPException(status_code=400, detail="No input message or file provided.")
+
+    input_text = ""
+    if file:
+        input_text += await process_pdf(file)
+    if message:
+        input_text += "\n" + message
+
+    if not input_text.strip():
+        raise HTTPException(status_code=400, detail="No input message or file provided.")
+    return input_text
+
 
 # New function to process chat request with all logic embedded
-#async def process_chat_request(request: Request, message: Optional[str] = Form(None), history: Optional[str] = Form(None), file: Optional[UploadFile] = Depends(get_file)) -> Dict:
-async def process_chat_request(request: Request, message: Optional[str] = Form(None), file: Optional[UploadFile] = Depends(get_file)) -> Dict:
+async def process_chat_request(request: Request, background_tasks: BackgroundTasks, message: Optional[str] = Form(None), file: Optional[UploadFile] = Depends(get_file)) -> Dict:
+    build_llm_chains()
     try:
-        form_data = await request.form()
-        logger.info(f"Received raw request: {dict(form_data)}")
+        # FastAPI has already parsed the form into message/file; don't re-read the body
+        logger.debug("message=%r file=%s", message, file.filename if file else None)
 
         # Extract session ID from headers, fallback to new UUID if not present
         session_id = request.headers.get("X-Session-ID", str(uuid.uuid4()))
-        logger.info(f"Processing request for session ID: {session_id}")
+        logger.info("Processing request for session ID: %s", session_id)
 
         # Build input string
-        input_text = ""
-        if file:
-            input_text += await process_pdf(file)
-        if message:
-            input_text += "\n" + message
-
-        if not input_text.strip():
-            raise HTTPException(status_code=400, detail="No input message or file provided.")
-
-        # Inner function to get or create session-specific memory
-        def get_session_memory(session_id: str) -> ConversationSummaryMemory:
-            if session_id not in session_memories:
-                session_memories[session_id] = ConversationSummaryMemory(llm=llm, memory_key="chat_history", return_messages=True, output_key="response")
-                logger.info(f"Created new memory instance for session: {session_id}")
-            return session_memories[session_id]
-
-
-
-        # Inner function to get chain
-        def get_chain(session_id: str):
-            memory = get_session_memory(session_id)
-            return (
-                RunnableParallel({
-                    "input": RunnablePassthrough(),
-                    "chat_history": RunnableLambda(lambda _: memory.load_memory_variables({}).get("chat_history", []))
-                })
-                | ChatPromptTemplate.from_template("""
-You are an expert medical assistant in the areas of modern medicines and also home remedies including Ayurveda.
-Your goal is to help diagnose a patient's condition and suggest modern as well as natural homemade medications based on the input provided.
-Your default language is English and You should respond in the same language and in the same language script, unless the user requests to change the language or script. (For example if user responds in hindi then ask "आपका नाम, उम्र, और लिंग क्या है?").
-Try and address the user with his or her name as much as you can except when the diagnosis is provided.                                                                               
-
-** Conversation Flow:
-- If any demographic information (name, age, gender) is not provided in the input or history, ask for missing specific information : 'for e.g. Could you please tell me your name, age, and gender?'.
-- Once demographic information is detected (e.g., name, age, gender), ask the necessary questions to identify the problem (for e.g, 'What symptoms are you experiencing?')
-- For each symptom provided (e.g., headache, nausea), ask follow-up questions to gather details, such as severity, duration, any other symptoms etc.
-  - After collecting sufficient symptoms with details, provide a diagnosis including:
-  - Condition name (you can use medical terminology here)
-  - Probability (confidence level as a float between 0 and 1)
-  - Provide a short medical genesis of this disease if it exists                                        
-  - Recommend medical tests to be done if needed, to further diagnose the problem (for e.g. blood test, urine test, etc.)
-  - Recommend modern medications (e.g., paracetamol for fever, ibuprofen for pain, etc.) based on the symptoms provided.
-  - Recommend lifestyle changes (e.g., rest, hydration, diet changes) based on the symptoms provided.
-  - Recommend any precaution which the user must take to avoid aggravation of the current condition(e.g , avoid spicy food, rest, etc.)
-  - Provide Local home remedy tailored by region if available (e.g., kadha in North India, rasam in South India, ajwain in Gujarat, etc.). You can provide specific home remedies based on the region of India if applicable.
-  - Also ensure that the final diagnosis response is converted into the same language and script as the user input.                                        
- 
-** Mandatory points to consider**
-- It is Mandatory to add a polite Goodbye message at the end of home remedy details withing the same string. 
-- Indent every sentence in a new line.                                         
-- If diagnosis can't be determined even after multiple questions and responses due to insufficient details or conflicting symptoms, advise: “Unable to determine the condition conclusively. Please consult a qualified doctor for further evaluation.”
-
-** Ensure that you:
-- Do not change the language on your own, unless user requests it (e.g., "Please respond in Hindi", "please hindi me bole" ..).
-- Do not provide any medical advice that is not based on the symptoms provided.
-- Do not Provide any information that is not related to the medical condition or home remedies.
-- Do not combine multiple questions in a single response. Try and ask one question at a time.
-- Do not overwhelm the patient/user with too many questions at once. Ask one question at a time and wait for the response before proceeding.
-- Do not make very long paragraphs in the final diagnosis, keep the final diagnosis short and in concise sentences buletted.
-                                                                                     
-**Respond in strict JSON format with the following structure:
-1. While asking questions: {{"question": "string", "diagnosis": null, "home_remedy": null, "diet_plan": null}}
-2. When providing diagnosis: {{"question": null, "diagnosis": {{"condition": "string", "probability": float, "medical_tests": ["string"], "modern_medication": ["string"], "lifestyle_changes": ["string"], "precautions": "string"}}, "home_remedy": "string", "diet_plan": null}}
-3. If diagnosis is unclear: {{"question": null, "diagnosis": null, "home_remedy": null, "diet_plan": null}}
-
-                                           
-Ensure the response is valid JSON, without markdown code blocks (e.g., no ```json wrapping).
-                                          
-Previous conversation: {chat_history}
-Patient input: {input}
-""")
-                | llm
-                | StrOutputParser()
-                | RunnableLambda(parse_response)
-            )
-
-        # Execute the chain
-        chain = get_chain(session_id)
-        result = chain.invoke(input_text)
-        logger.info(f"Parsed response for session {session_id}: {result}")
-
-        # Store context for session-specific memory
-        memory = get_session_memory(session_id)
-        memory.save_context({"input": input_text}, {"response": json.dumps(result)})
+        input_text = await build_input_text(message, file)
+
+        # Turns on a session run one at a time while the history is read and the LLM answers
+        async with get_session_lock(session_id):
+            state = await load_session_state(session_id)
+            history = load_history(state)
+            cache_key = input_text if not history and not file else None
+            result = first_turn_cache.get(cache_key) if cache_key else None
+            if result is None:
+                result = await chat_chain.ainvoke({"input": input_text, "chat_history": history})
+                if cache_key and result != PARSE_FAILURE_RESPONSE:
+                    first_turn_cache[cache_key] = result
+            logger.info("Parsed response for session %s: %s", session_id, result)
+
+        # Store the turn in session state after the response is sent;
+        # the summary LLM call is then off the user-visible path
+        background_tasks.add_task(save_session_turn, session_id, input_text, result)
         
         # Check if this is a final response and close the session
         if result.get("question") is None:  # Final response (diagnosis or unclear)
             if session_id in session_memories:
                 #del session_memories[session_id]
-                logger.info(f"NOT Closing session {session_id} after final response. On to diet plan")
+                logger.info("NOT Closing session %s after final response. On to diet plan", session_id)
 
         return result
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Server error for session %s: %s", session_id, e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+# Function to stream a chat turn as server-sent events
+# Emits a "data" event per token chunk, then an "event: result" with the parsed response
+async def process_chat_stream(request: Request, message: Optional[str] = Form(None), file: Optional[UploadFile] = Depends(get_file)) -> StreamingResponse:
+    build_llm_chains()
+    session_id = request.headers.get("X-Session-ID", str(uuid.uuid4()))
+    try:
+        logger.info("Processing streaming request for session ID: %s", session_id)
+        input_text = await build_input_text(message, file)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Server error for session %s: %s", session_id, e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+    try:
+        # Held only while the history is read; save_turn takes it again to record the turn
+        async with get_session_lock(session_id):
+            state = await load_session_state(session_id)
+            prompt_value = await MEDICAL_PROMPT.ainvoke({"input": input_text, "chat_history": load_history(state)})
     except Exception as e:
-        logger.exception(f"Server error for session {session_id}: {e}")
+        logger.exception("Server error for session %s: %s", session_id, e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
-# def get_session_id(request: Request):
-#     return request.headers.get("X-Session-ID", str(uuid.uuid4()))
+    turn = {}
+
+    async def event_stream():
+        chunks = []
+        scanner = JsonObjectScanner()
+        try:
+            # Stop as soon as the JSON object closes; aclosing cancels the rest of the generation
+            async with aclosing(json_llm.astream(prompt_value)) as stream:
+                async for chunk in stream:
+                    content = chunk.content
+                    end = scanner.feed(content)
+                    if end != -1:
+                        content = content[:end]
+                    chunks.append(content)
+                    yield f"data: {orjson.dumps({'delta': content}).decode()}\n\n"
+                    if end != -1:
+                        break
+        except Exception as e:
+            logger.exception("Streaming error for session %s: %s", session_id, e)
+            yield f"event: error\ndata: {orjson.dumps({'detail': 'Internal server error'}).decode()}\n\n"
+            return
+
+        result = parse_response("".join(chunks))
+        logger.info("Parsed streamed response for session %s: %s", session_id, result)
+        turn["result"] = result
+        yield f"event: result\ndata: {orjson.dumps(result).decode()}\n\n"
+
+    # Runs after the last byte is sent, so the summary call never delays the stream
+    async def save_turn():
+        if "result" in turn:
+            await save_session_turn(session_id, input_text, turn["result"])
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", background=BackgroundTask(save_turn))
 
 # Function to process diet plan request
 async def process_diet_plan(request: Request, message: Optional[str] = Form(None), condition: Optional[str] =  Form(None) ) -> Dict:
+    build_llm_chains()
     try:
       
         session_id = request.headers.get("X-Session-ID", str(uuid.uuid4()))
         
 
-        logger.info(f"Received diet plan request for session ID: {session_id}")
-        logger.info(f"Received message: {message}, \ncondition: {condition}")
+        logger.info("Received diet plan request for session ID: %s", session_id)
+        logger.info("Received message: %s, \ncondition: %s", message, condition)
         
         if condition is None or condition.strip() == "":
             raise HTTPException(status_code=400, detail="Condition is required for diet planning.")
-        # Get session memory
-        def get_session_memory(session_id: str) -> ConversationSummaryMemory:
-            if session_id not in session_memories:
-                session_memories[session_id] = ConversationSummaryMemory(llm=llm, memory_key="chat_history", return_messages=True, output_key="response")
-                logger.info(f"Created new memory instance for session: {session_id}")
-            return session_memories[session_id]
-
-        memory = get_session_memory(session_id)
-        context = memory.load_memory_variables({}).get("chat_history", [])
-        logger.info(f"Loaded context for session {session_id}: {context}")
-
-        # Diet planning conversational flow
-        input_text = message or ""
-        diet_prompt = ChatPromptTemplate.from_template("""
-You are an expert dietitian. Based on the diagnosed condition: {condition}, your goal is to create a personalized diet plan for the user.
-Previous conversation: {chat_history}
-Patient input: {input}                                 
-
-However, before you create the plan, gather the following essential details by asking these questions one by one:
-1. Dietary preferences (Veg, Non-veg, Vegan, Jain, etc.)
-2. Any food allergies
-3. Any food items the user dislikes or wants to avoid.
-4. Specific dietary restrictions (e.g. low-carb, high-protein) — assume the answer to be no if no satisfactory response is received
-5. Number of days the user wants the diet plan for (default to 7 days if not provided)
-6. Any specific health goals (e.g., weight loss, muscle gain, etc.) — assume the answer to be no if no satisfactory response is received
-                                                       
-**Rules:**
-- No markdown formatting (no ```json)
-- Respond in the user's language only if they request it
-- Do not repeat previously asked or answered questions
-- Avoid generic statements or medical advice
-- Do not repeat any questions. If the answer is not satisfactory, then assuem it to be the safest vaule and mention it to the user                                        
-- Do not ask for re-confirmations on already provided information
-- Do not repeast any quesions. Take a safe assumtiopn for unasnwered question, and move on to the next step
-- Once required info is collected, generate a clear, day-wise plan (with meal times)
-- Take into account the time of the year based on the current date and availabilituy of suggested food items. (For e,g. Oranges are not available in winters, so do not suggest them)
-- End with a short, polite goodbye message
-
-**Output format (strict JSON):**
-- While asking questions: 
-  {{ "question": "your question here", "diagnosis": null, "home_remedy": null, "diet_plan": null }}
-- When providing the final plan:
-  {{ "question": null, "diagnosis": null, "home_remedy": null, "diet_plan": "final plan string" }}
-
-
-""")
-        chain = (
-            RunnableParallel({
-                "input": RunnablePassthrough(),
-                "chat_history": RunnableLambda(lambda _: context),
-                "condition": RunnableLambda(lambda _: condition)
-            })
-            | diet_prompt
-            | llm
-            | StrOutputParser()
-            | RunnableLambda(parse_response)
-        )
-
-        result = chain.invoke(input_text)
-        logger.info(f"Diet plan response for session {session_id}: {result}")
-
-        # Update memory with the response
-        memory.save_context({"input": input_text}, {"response": json.dumps(result)})
+        async with get_session_lock(session_id):
+            state = await load_session_state(session_id)
+            context = load_history(state)
+            logger.debug("Loaded context for session %s: %s", session_id, context)
+
+            # Diet planning conversational flow
+            input_text = message or ""
+            result = await diet_chain.ainvoke({"input": input_text, "chat_history": context, "condition": condition})
+            logger.info("Diet plan response for session %s: %s", session_id, result)
+
+            # Update session state with the response
+            await record_session_turn(session_id, state, input_text, result)
 
         # Close session if diet plan is provided
         if result.get("question") is None:  # Final response with diet plan
-            logger.info(f"Final diet plan provided for session {session_id}: {result.get('diet_plan')}")
-            if session_id in session_memories:
-                del session_memories[session_id]
-                logger.info(f"Closed session {session_id} after diet plan")
+            logger.info("Final diet plan provided for session %s: %s", session_id, result.get('diet_plan'))
+            await close_session(session_id)
+            logger.info("Closed session %s after diet plan", session_id)
 
         return result
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Server error for session {session_id}: {e}")
+        logger.exception("Server error for session %s: %s", session_id, e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 # Pydantic models
-class Message(BaseModel):
-    id: str
-    text: str
-    isUser: bool
-    timestamp: str
-
 class ChatResponse(BaseModel):
     question: Optional[str] = None
     diagnosis: Optional[Dict] = None
@@ -429,13 +795,20 @@ class ChatResponse(BaseModel):
 # Main API endpoints
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    message: Optional[str] = Form(None),
+    file: Optional[UploadFile] = Depends(get_file)
+):
+    return await process_chat_request(request, background_tasks, message, file)
+
+@app.post("/api/chat/stream")
+async def chat_stream(
     request: Request,
     message: Optional[str] = Form(None),
-#    history: Optional[str] = Form(None),
     file: Optional[UploadFile] = Depends(get_file)
 ):
-#   return await process_chat_request(request, message, history, file)
-    return await process_chat_request(request, message, file)
+    return await process_chat_stream(request, message, file)
 
 @app.post("/api/diet", response_model=ChatResponse)
 async def diet(
@@ -0,0 +1,33 @@
+import io
+from itertools import islice
+import pypdfium2 as pdfium
+from pypdf import PdfReader
+from typing import Tuple
+
+# Plain-text extraction for uploaded PDFs.
+# PDFium is not thread-safe, so these run in worker processes; keep this module
+# free of app imports so the workers start without loading the LLM stack.
+
+
+def extract_page_range(data: bytes, start: int, stop: int) -> Tuple[str, int]:
+    """Extract text from pages [start, stop) with PDFium. Also returns the document's page count."""
+    pdf = pdfium.PdfDocument(data)
+    try:
+        page_count = len(pdf)
+        texts = []
+        for i in range(start, min(stop, page_count)):
+            # Free each page's native objects as soon as its text is copied out
+            page = pdf[i]
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_bounded())
+            textpage.close()
+            page.close()
+        return "\n".join(texts), page_count
+    finally:
+        pdf.close()
+
+
+def extract_with_pypdf(data: bytes, max_pages: int) -> str:
+    """Fallback for files PDFium can't read; pypdf extracts text without layout analysis."""
+    reader = PdfReader(io.BytesIO(data))
+    return "\n".join(page.extract_text() or "" for page in islice(reader.pages, max_pages))
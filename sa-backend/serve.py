@@ -0,0 +1,23 @@
+import os
+import uvicorn
+from dotenv import load_dotenv
+
+# Production entry point: python serve.py
+# Kept separate from main.py because spawned child processes (uvicorn workers, the PDF
+# pool) re-import the __main__ module; this one loads nothing but uvicorn.
+#
+# WEB_CONCURRENCY sets the worker count. It defaults to one per CPU when REDIS_URL is set
+# (session state and turn locks then live in Redis), and to a single worker otherwise, since
+# in-process sessions and locks aren't shared between workers.
+
+if __name__ == "__main__":
+    load_dotenv()
+    default_workers = (os.cpu_count() or 1) if os.getenv("REDIS_URL") else 1
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "5000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", default_workers)),
+        loop="uvloop",
+        http="httptools",
+    )
@@ -0,0 +1,100 @@
+import os
+import random
+
+import orjson
+import pytest
+
+# main builds its Gemini clients at import; no request is made in these tests
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+from main import JsonObjectScanner, escape_unescaped_newlines, extract_json_object  # noqa: E402
+
+# Run from sa-backend: python -m pytest -q
+
+SAMPLES = [
+    '{"a": 1}',
+    'Sure! {"question": "Why {x}?", "diagnosis": null} trailing {"b": 2}',
+    '```json\n{"a": "}{", "b": {"c": [1, {"d": 2}]}}\n```',
+    'He said "hi" then {"q": "a \\"quoted\\" } brace", "n": {}} done',
+    '{"path": "C:\\\\dir\\\\", "x": "{"}',
+]
+
+
+def scan_in_chunks(text: str, chunks: list) -> str:
+    """Feed chunks to a fresh scanner and return the text up to where it reports the close."""
+    scanner = JsonObjectScanner()
+    seen = []
+    for chunk in chunks:
+        end = scanner.feed(chunk)
+        if end != -1:
+            seen.append(chunk[:end])
+            return "".join(seen)
+        seen.append(chunk)
+    return ""
+
+
+def random_chunks(text: str, rng: random.Random) -> list:
+    cuts = sorted(rng.sample(range(1, len(text)), rng.randint(0, min(8, len(text) - 1))))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def test_extract_ignores_braces_inside_strings():
+    text = 'x {"a": "}{", "b": {"c": "{{"}} y'
+    assert extract_json_object(text) == '{"a": "}{", "b": {"c": "{{"}}'
+
+
+def test_extract_handles_escaped_quotes():
+    text = '{"q": "say \\"}\\" now", "n": 1} tail'
+    assert orjson.loads(extract_json_object(text)) == {"q": 'say "}" now', "n": 1}
+
+
+def test_extract_handles_escaped_backslash_before_quote():
+    assert extract_json_object('{"p": "C:\\\\"} {"x": 1}') == '{"p": "C:\\\\"}'
+
+
+def test_extract_unterminated_string_raises():
+    with pytest.raises(ValueError):
+        extract_json_object('{"a": "never closed }')
+
+
+def test_extract_without_object_raises():
+    with pytest.raises(ValueError):
+        extract_json_object("no json here")
+    with pytest.raises(ValueError):
+        extract_json_object('{"a": {"b": 1}')
+
+
+def test_escape_newlines_only_inside_strings():
+    text = '{\n "a": "line1\nline2\r\n",\n "b": ["x\ny"]\n}'
+    escaped = escape_unescaped_newlines(text)
+    assert escaped == '{\n "a": "line1\\nline2\\r\\n",\n "b": ["x\\ny"]\n}'
+    assert orjson.loads(escaped) == {"a": "line1\nline2\r\n", "b": ["x\ny"]}
+
+
+def test_escape_newlines_after_escaped_quote():
+    escaped = escape_unescaped_newlines('{"q": "a \\"b\\"\nc"}')
+    assert orjson.loads(escaped) == {"q": 'a "b"\nc'}
+
+
+def test_escape_newlines_unterminated_string():
+    assert escape_unescaped_newlines('{"a": "open\nstring') == '{"a": "open\\nstring'
+
+
+def test_scanner_ignores_braces_and_quotes_in_strings():
+    text = '{"a": "}\\"{", "b": {}} rest'
+    assert scan_in_chunks(text, [text]) == '{"a": "}\\"{", "b": {}}'
+
+
+def test_scanner_unterminated_string_never_closes():
+    scanner = JsonObjectScanner()
+    assert scanner.feed('{"a": "open } }') == -1
+    assert scanner.feed(" still open }") == -1
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_scanner_matches_extract_for_random_chunk_splits(text):
+    expected = extract_json_object(text)
+    rng = random.Random(text)
+    for _ in range(200):
+        scanned = scan_in_chunks(text, random_chunks(text, rng))
+        assert scanned[scanned.index("{"):] == expected